@@ -1,16 +1,59 @@
+import asyncio
+import codecs
+import gzip
+import hashlib
 import os
 import io
 import csv
+import pathlib
 import json
+import re
+import sys
+import time
+from collections import namedtuple, OrderedDict
+from functools import lru_cache
 from typing import Optional, List, Dict, Any
 from urllib.parse import urlparse
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Header, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, Depends, File, Form, HTTPException, Header, Request, Response
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
 
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI
+
+# pandas があれば C 実装の CSV パーサを使う（数万行の Ahrefs エクスポートで効く）
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+# charset-normalizer があれば先頭64KBだけで文字コードを判定する（全文の再デコードを防ぐ）
+try:
+    from charset_normalizer import from_bytes as cn_from_bytes
+except ImportError:
+    cn_from_bytes = None
+
+# orjson（Rust実装）があれば大きなJSONのシリアライズに使う
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# brotli があれば HTML の事前圧縮に使う（gzipより2割ほど小さくなる）
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def json_dumps_utf8(obj) -> str:
+    if orjson is not None:
+        # pandas由来のnumpyスカラーが混ざってもそのまま書き出せるようにする
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False)
 
 
 # ======================
@@ -25,661 +68,135 @@ def require_access_token(x_access_token: Optional[str]) -> None:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
 
+def _auth(x_access_token: Optional[str] = Header(default=None, alias="X-Access-Token")) -> None:
+    # Depends で各エンドポイントに宣言的に付ける。ボディ処理やLLM呼び出しの前に401で弾く
+    require_access_token(x_access_token)
+
+
 # ======================
 # 埋め込みHTML（フロントエンド）
 # ======================
 
-HTML_PAGE = """<!DOCTYPE html>
-<html lang="ja">
-<head>
-  <meta charset="UTF-8" />
-  <title>Ahrefs CSV → SEOレポート自動生成</title>
-  <style>
-    body {
-      font-family: system-ui, -apple-system, BlinkMacSystemFont, "Segoe UI", sans-serif;
-      max-width: 980px;
-      margin: 24px auto;
-      padding: 0 16px 40px;
-      background: #f5f7fb;
-    }
-    h1 { font-size: 1.6rem; margin-bottom: 0.5rem; }
-
-    .card {
-      background: #fff;
-      border-radius: 12px;
-      padding: 16px 20px;
-      box-shadow: 0 4px 18px rgba(0,0,0,0.06);
-      margin-bottom: 16px;
-    }
-
-    label {
-      display: block;
-      font-size: 0.9rem;
-      margin: 8px 0 4px;
-      font-weight: 600;
-    }
-
-    input[type="text"],
-    input[type="month"],
-    input[type="password"],
-    textarea {
-      width: 100%;
-      padding: 8px 10px;
-      border-radius: 8px;
-      border: 1px solid #cbd5e1;
-      font-size: 0.9rem;
-      box-sizing: border-box;
-    }
-
-    textarea {
-      min-height: 280px;
-      resize: vertical;
-      font-family: SFMono-Regular, Menlo, Monaco, Consolas, "Liberation Mono", "Courier New", monospace;
-      white-space: pre-wrap;
-    }
-
-    .btn {
-      display: inline-flex;
-      align-items: center;
-      justify-content: center;
-      padding: 8px 16px;
-      border-radius: 999px;
-      border: none;
-      background: linear-gradient(135deg, #2563eb, #4f46e5);
-      color: #fff;
-      font-size: 0.95rem;
-      font-weight: 600;
-      cursor: pointer;
-    }
-    .btn:disabled { opacity: 0.6; cursor: default; }
-    .btn-secondary { background: #0f172a; }
-    .btn-ghost { background: #e2e8f0; color: #0f172a; }
-
-    .status {
-      font-size: 0.85rem;
-      color: #475569;
-      margin-left: 8px;
-      word-break: break-word;
-    }
-    .status.error { color: #b91c1c; }
-
-    .button-row {
-      margin-top: 12px;
-      display: flex;
-      flex-wrap: wrap;
-      gap: 8px;
-      align-items: center;
-    }
-
-    .drop-area {
-      margin-top: 4px;
-      padding: 16px;
-      border: 2px dashed #cbd5e1;
-      border-radius: 10px;
-      text-align: center;
-      font-size: 0.85rem;
-      color: #64748b;
-      background: #f8fafc;
-      cursor: pointer;
-      user-select: none;
-    }
-    .drop-area.highlight {
-      border-color: #2563eb;
-      background: #eff6ff;
-      color: #1d4ed8;
-    }
-
-    .subtext {
-      font-size: 0.8rem;
-      color: #64748b;
-      margin-top: 4px;
-      display: block;
-    }
-
-    /* Dashboard */
-    .dash-title {
-      font-size: 1rem;
-      font-weight: 700;
-      margin-bottom: 8px;
-    }
-    #dash-wrap {
-      border: 1px solid #e2e8f0;
-      background: #ffffff;
-      border-radius: 12px;
-      padding: 12px;
-    }
-    .dash-grid {
-      display: grid;
-      grid-template-columns: repeat(3, minmax(0, 1fr));
-      gap: 10px;
-    }
-    .dash-box {
-      background: #f8fafc;
-      border-radius: 10px;
-      padding: 10px 10px;
-      border: 1px solid #e2e8f0;
-    }
-    .dash-label { color: #64748b; font-size: 0.78rem; }
-    .dash-value { font-size: 1.05rem; font-weight: 800; margin-top: 2px; }
-    .dash-mini { color: #64748b; font-size: 0.75rem; margin-top: 2px; }
-
-    .bar-outer {
-      margin-top: 8px;
-      height: 8px;
-      width: 100%;
-      border-radius: 999px;
-      background: #e2e8f0;
-      overflow: hidden;
-    }
-    .bar-inner {
-      height: 100%;
-      width: 0%;
-      border-radius: 999px;
-      background: linear-gradient(90deg, #2563eb, #4f46e5);
-      transition: width 0.3s ease;
-    }
-
-    @media (max-width: 720px) {
-      .dash-grid { grid-template-columns: 1fr; }
-    }
-  </style>
-</head>
-<body>
-  <h1>Ahrefs CSV → SEOレポート自動生成</h1>
-  <p style="font-size:0.9rem;color:#475569;">
-    1) Ahrefsから先月・今月のCSVを出す → 2) ここでアップロード → 3) レポート生成 → 4) Notionにコピペ
-  </p>
-
-  <div class="card">
-    <form id="report-form">
-      <label>アクセス用トークン（共通パスワード）</label>
-      <input type="password" id="access_token" placeholder="チーム共有のトークンを入力" required />
-
-      <div class="button-row" style="margin-top:8px;">
-        <label style="display:flex;gap:8px;align-items:center;font-weight:600;margin:0;">
-          <input type="checkbox" id="remember_token" />
-          この端末にトークンを保存
-        </label>
-        <button type="button" class="btn btn-ghost" id="forget_token_btn">保存トークンを削除</button>
-      </div>
-      <span class="subtext">※ 共有PCの場合は保存しないでください（保存するとそのPCのブラウザに残ります）</span>
-
-      <label>クリニック名（タイトル用）</label>
-      <input type="text" name="clinic_name" id="clinic_name" placeholder="例：長尾歯科医院" />
-      <span class="subtext">未入力の場合はドメイン名で代用します</span>
-
-      <label>対象サイトのURL</label>
-      <input type="text" name="domain" id="domain" placeholder="https://example-clinic.com" required />
-
-      <label>先月（ここを選ぶと今月が自動反映されます）</label>
-      <input type="month" name="month_prev" id="month_prev" required />
-
-      <label>今月</label>
-      <input type="month" name="month_current" id="month_current" required />
-
-      <label>ブログ判定パス（カンマ区切り）</label>
-      <input type="text" name="blog_paths" value="/blog,/column" />
-      <span class="subtext">例: /blog,/column,/news/column など（URL内に含まれていればブログ扱い）</span>
-
-      <label>レポートタイトル（自動生成）</label>
-      <input type="text" id="title-field" readonly />
-      <div class="button-row" style="margin-top:8px;">
-        <button type="button" class="btn btn-ghost" id="copy-title-btn">タイトルをコピー</button>
-      </div>
-
-      <label>先月のCSV（Top pages）</label>
-      <div class="drop-area" id="drop-prev">
-        <span id="prev-file-label">ここにファイルをドロップするか、クリックして選択</span>
-      </div>
-      <input type="file" name="prev_csv" id="prev_csv" accept=".csv" style="display:none" required />
-
-      <label>今月のCSV（Top pages）</label>
-      <div class="drop-area" id="drop-curr">
-        <span id="curr-file-label">ここにファイルをドロップするか、クリックして選択</span>
-      </div>
-      <input type="file" name="curr_csv" id="curr_csv" accept=".csv" style="display:none" required />
-
-      <div class="button-row">
-        <button type="submit" class="btn" id="submit-btn">レポートを生成する</button>
-        <button type="button" class="btn btn-secondary" id="clear-btn">一括クリア</button>
-        <span class="status" id="status"></span>
-      </div>
-    </form>
-  </div>
-
-  <div class="card" id="dash-card" style="display:none;">
-    <div class="dash-title">📊 全体トラフィック（先月⇄今月）</div>
-
-    <div id="dash-wrap">
-      <div style="display:flex;justify-content:space-between;gap:8px;align-items:flex-end;flex-wrap:wrap;">
-        <div style="font-weight:800;" id="dash-headline">—</div>
-        <div style="color:#64748b;font-size:0.8rem;" id="dash-sub">—</div>
-      </div>
-
-      <div class="dash-grid" style="margin-top:10px;">
-        <div class="dash-box">
-          <div class="dash-label">先月 合計トラフィック</div>
-          <div class="dash-value" id="dash-prev">-</div>
-          <div class="bar-outer"><div class="bar-inner" id="bar-prev"></div></div>
-        </div>
-        <div class="dash-box">
-          <div class="dash-label">今月 合計トラフィック</div>
-          <div class="dash-value" id="dash-current">-</div>
-          <div class="bar-outer"><div class="bar-inner" id="bar-current"></div></div>
-        </div>
-        <div class="dash-box">
-          <div class="dash-label">差分 / 変化率</div>
-          <div class="dash-value" id="dash-diff">-</div>
-          <div class="dash-mini" id="dash-diff-note">—</div>
-          <div class="bar-outer"><div class="bar-inner" id="bar-diff"></div></div>
-        </div>
-      </div>
-    </div>
-
-    <span class="subtext">この枠ごとスクショしてレポート冒頭に貼ると分かりやすいです。</span>
-  </div>
-
-  <div class="card">
-    <label>生成されたレポート（Markdown / NotionにそのままコピペOK）</label>
-    <textarea id="report-output" placeholder="ここにレポートが表示されます"></textarea>
-    <span class="subtext" id="char-count">文字数: 0</span>
-    <div class="button-row" style="margin-top:8px;">
-      <button class="btn btn-ghost" id="copy-btn" disabled>レポートをコピー</button>
-      <button class="btn btn-secondary" id="download-btn" disabled>.mdとしてダウンロード</button>
-    </div>
-  </div>
-
-  <script>
-    const BACKEND_URL = "/generate-report";
-
-    const form = document.getElementById("report-form");
-    const statusEl = document.getElementById("status");
-    const submitBtn = document.getElementById("submit-btn");
-    const clearBtn = document.getElementById("clear-btn");
-
-    const output = document.getElementById("report-output");
-    const dlBtn = document.getElementById("download-btn");
-    const copyBtn = document.getElementById("copy-btn");
-    const charCountEl = document.getElementById("char-count");
-
-    const accessTokenInput = document.getElementById("access_token");
-    const rememberTokenCheckbox = document.getElementById("remember_token");
-    const forgetTokenBtn = document.getElementById("forget_token_btn");
-    const TOKEN_KEY = "report_access_token_v1";
-
-    const clinicNameInput = document.getElementById("clinic_name");
-    const domainInput = document.getElementById("domain");
-    const monthPrevInput = document.getElementById("month_prev");
-    const monthCurrentInput = document.getElementById("month_current");
-    const titleField = document.getElementById("title-field");
-    const copyTitleBtn = document.getElementById("copy-title-btn");
-
-    const prevInput = document.getElementById("prev_csv");
-    const currInput = document.getElementById("curr_csv");
-    const prevDrop = document.getElementById("drop-prev");
-    const currDrop = document.getElementById("drop-curr");
-    const prevLabel = document.getElementById("prev-file-label");
-    const currLabel = document.getElementById("curr-file-label");
-
-    const dashCard = document.getElementById("dash-card");
-    const dashHeadline = document.getElementById("dash-headline");
-    const dashSub = document.getElementById("dash-sub");
-    const dashPrev = document.getElementById("dash-prev");
-    const dashCurrent = document.getElementById("dash-current");
-    const dashDiff = document.getElementById("dash-diff");
-    const dashDiffNote = document.getElementById("dash-diff-note");
-    const barPrev = document.getElementById("bar-prev");
-    const barCurrent = document.getElementById("bar-current");
-    const barDiff = document.getElementById("bar-diff");
-
-    let lastFilename = "report.md";
-
-    function preventDefaults(e) { e.preventDefault(); e.stopPropagation(); }
-
-    function setupDropArea(dropEl, inputEl, labelEl) {
-      ["dragenter", "dragover", "dragleave", "drop"].forEach(ev => {
-        dropEl.addEventListener(ev, preventDefaults, false);
-      });
-      ["dragenter", "dragover"].forEach(ev => {
-        dropEl.addEventListener(ev, () => dropEl.classList.add("highlight"), false);
-      });
-      ["dragleave", "drop"].forEach(ev => {
-        dropEl.addEventListener(ev, () => dropEl.classList.remove("highlight"), false);
-      });
-
-      dropEl.addEventListener("click", () => inputEl.click());
-
-      dropEl.addEventListener("drop", (e) => {
-        const file = e.dataTransfer.files[0];
-        if (!file) return;
-        const dt = new DataTransfer();
-        dt.items.add(file);
-        inputEl.files = dt.files;
-        labelEl.textContent = file.name;
-      });
-
-      inputEl.addEventListener("change", () => {
-        if (inputEl.files && inputEl.files[0]) {
-          labelEl.textContent = inputEl.files[0].name;
-        } else {
-          labelEl.textContent = "ここにファイルをドロップするか、クリックして選択";
-        }
-      });
-    }
-
-    function updateCharCount() {
-      charCountEl.textContent = "文字数: " + (output.value.length).toString();
-    }
-
-    function monthToJP(ym) {
-      if (!ym) return "";
-      const [y, m] = ym.split("-");
-      if (!y || !m) return ym;
-      return `${y}年${parseInt(m, 10)}月`;
-    }
-
-    function parseHostname(url) {
-      try { return new URL(url).host; } catch(e) { return url || ""; }
-    }
-
-    function addOneMonth(ym) {
-      if (!ym) return "";
-      const parts = ym.split("-");
-      if (parts.length !== 2) return "";
-      let y = parseInt(parts[0], 10);
-      let m = parseInt(parts[1], 10);
-      if (isNaN(y) || isNaN(m)) return "";
-      m += 1;
-      if (m > 12) { m = 1; y += 1; }
-      return `${y}-${String(m).padStart(2, "0")}`;
-    }
-
-    function updateTitleField() {
-      const prev = monthPrevInput.value;
-      const curr = monthCurrentInput.value;
-      const clinic = (clinicNameInput.value || "").trim();
-      const dom = parseHostname(domainInput.value || "");
-      if (!prev || !curr) { titleField.value = ""; return; }
-      const name = clinic ? clinic : dom;
-      titleField.value = `${monthToJP(prev)}と${monthToJP(curr)}のアクセス比較分析（${name}）`;
-    }
-
-    function formatNum(n) {
-      if (n === null || n === undefined) return "-";
-      return Math.round(n).toLocaleString("ja-JP");
-    }
-    function formatPct(p) {
-      if (p === null || p === undefined) return "-";
-      return (Math.round(p * 10) / 10).toString() + "%";
-    }
-
-    function updateDashboard(summary, titleText) {
-      if (!summary || !summary.all) { dashCard.style.display = "none"; return; }
-      const all = summary.all;
-      const prev = all.total_traffic_prev || 0;
-      const curr = all.total_traffic_current || 0;
-      const diff = all.total_diff || 0;
-      const ratio = all.total_diff_ratio;
-
-      dashHeadline.textContent = titleText || "全体トラフィックの推移";
-      dashSub.textContent = "※ Ahrefs Top pages（CSV）集計";
-
-      dashPrev.textContent = formatNum(prev);
-      dashCurrent.textContent = formatNum(curr);
-
-      const sign = diff >= 0 ? "+" : "";
-      dashDiff.textContent = `${sign}${formatNum(diff)} / ${formatPct(ratio)}`;
-
-      let note = "";
-      if (prev === 0 && curr > 0) note = "先月が0のため変化率は参考値です";
-      if (prev > 0 && Math.abs(diff) < (prev * 0.05)) note = "変化は小さめ（±5%以内）";
-      if (prev > 0 && diff > (prev * 0.1)) note = "増加傾向（+10%超）";
-      if (prev > 0 && diff < -(prev * 0.1)) note = "減少傾向（-10%超）";
-      dashDiffNote.textContent = note;
-
-      const maxVal = Math.max(prev, curr, Math.abs(diff), 1);
-      barPrev.style.width = Math.round((prev / maxVal) * 100) + "%";
-      barCurrent.style.width = Math.round((curr / maxVal) * 100) + "%";
-      barDiff.style.width = Math.round((Math.abs(diff) / maxVal) * 100) + "%";
-
-      dashCard.style.display = "block";
-    }
+# フロントエンドは main.py 内の巨大文字列から index.html に分離。
+# 起動時に一度だけバイト列で読み込む（.pyc が軽くなり import も速い）
+HTML_PAGE_BYTES = (pathlib.Path(__file__).with_name("index.html")).read_bytes()
 
-    setupDropArea(prevDrop, prevInput, prevLabel);
-    setupDropArea(currDrop, currInput, currLabel);
-
-    output.addEventListener("input", updateCharCount);
-
-    clinicNameInput.addEventListener("input", updateTitleField);
-    domainInput.addEventListener("input", updateTitleField);
-
-    monthPrevInput.addEventListener("change", () => {
-      monthCurrentInput.value = addOneMonth(monthPrevInput.value);
-      updateTitleField();
-    });
-    monthCurrentInput.addEventListener("change", updateTitleField);
-
-    copyTitleBtn.addEventListener("click", async () => {
-      try {
-        if (!titleField.value) updateTitleField();
-        await navigator.clipboard.writeText(titleField.value || "");
-        statusEl.textContent = "タイトルをコピーしました。";
-        statusEl.classList.remove("error");
-      } catch(e) {
-        statusEl.textContent = "タイトルのコピーに失敗しました。";
-        statusEl.classList.add("error");
-      }
-    });
-
-    // 起動時に保存トークンがあれば復元
-    window.addEventListener("DOMContentLoaded", () => {
-      const saved = localStorage.getItem(TOKEN_KEY);
-      if (saved) {
-        accessTokenInput.value = saved;
-        rememberTokenCheckbox.checked = true;
-      }
-    });
-
-    // 保存トークンを削除
-    forgetTokenBtn.addEventListener("click", () => {
-      localStorage.removeItem(TOKEN_KEY);
-      accessTokenInput.value = "";
-      rememberTokenCheckbox.checked = false;
-      statusEl.textContent = "保存トークンを削除しました。";
-      statusEl.classList.remove("error");
-    });
-
-    form.addEventListener("submit", async (e) => {
-      e.preventDefault();
-      statusEl.textContent = "";
-      statusEl.classList.remove("error");
-      output.value = "";
-      updateCharCount();
-      dlBtn.disabled = true;
-      copyBtn.disabled = true;
-      dashCard.style.display = "none";
-
-      updateTitleField();
-
-      const token = (accessTokenInput.value || "").trim();
-      if (!token) {
-        statusEl.textContent = "アクセス用トークンを入力してください。";
-        statusEl.classList.add("error");
-        return;
-      }
-
-      // トークン保存（チェックONのときだけ）
-      if (rememberTokenCheckbox.checked) {
-        localStorage.setItem(TOKEN_KEY, token);
-      } else {
-        localStorage.removeItem(TOKEN_KEY);
-      }
-
-      const fd = new FormData(form);
-
-      submitBtn.disabled = true;
-      submitBtn.textContent = "生成中...";
-      statusEl.textContent = "OpenAIでレポート生成中です…";
-
-      try {
-        const res = await fetch(BACKEND_URL, {
-          method: "POST",
-          headers: { "X-Access-Token": token },
-          body: fd
-        });
-
-        if (!res.ok) {
-          let serverMessage = "";
-          try {
-            const ct = res.headers.get("content-type") || "";
-            if (ct.includes("application/json")) {
-              const j = await res.json();
-              serverMessage = j.detail || JSON.stringify(j);
-            } else {
-              serverMessage = await res.text();
-            }
-          } catch (e) {
-            serverMessage = "(サーバーメッセージの解析に失敗しました)";
-          }
-          throw new Error(`サーバーエラー: ${res.status} ${serverMessage}`);
-        }
-
-        const data = await res.json();
-        output.value = data.report || "";
-        lastFilename = data.filename || "report.md";
-        if (data.title) titleField.value = data.title;
-
-        updateCharCount();
-        const hasText = !!output.value;
-        dlBtn.disabled = !hasText;
-        copyBtn.disabled = !hasText;
-
-        if (data.summary) updateDashboard(data.summary, titleField.value || "全体トラフィックの推移");
-
-        statusEl.textContent = "完了！Notionに貼り付けてください。";
-      } catch (err) {
-        console.error(err);
-        statusEl.textContent = err.message || "エラーが発生しました。";
-        statusEl.classList.add("error");
-      } finally {
-        submitBtn.disabled = false;
-        submitBtn.textContent = "レポートを生成する";
-      }
-    });
-
-    // 一括クリア：トークンは消さない
-    clearBtn.addEventListener("click", () => {
-      form.reset();
-
-      prevLabel.textContent = "ここにファイルをドロップするか、クリックして選択";
-      currLabel.textContent = "ここにファイルをドロップするか、クリックして選択";
-
-      output.value = "";
-      updateCharCount();
-      dlBtn.disabled = true;
-      copyBtn.disabled = true;
-      lastFilename = "report.md";
-      titleField.value = "";
-      dashCard.style.display = "none";
-
-      statusEl.textContent = "";
-      statusEl.classList.remove("error");
-
-      const saved = localStorage.getItem(TOKEN_KEY);
-      if (saved) {
-        accessTokenInput.value = saved;
-        rememberTokenCheckbox.checked = true;
-      } else {
-        accessTokenInput.value = "";
-        rememberTokenCheckbox.checked = false;
-      }
-    });
-
-    dlBtn.addEventListener("click", () => {
-      const blob = new Blob([output.value], { type: "text/markdown;charset=utf-8" });
-      const url = URL.createObjectURL(blob);
-      const a = document.createElement("a");
-      a.href = url;
-      a.download = lastFilename;
-      document.body.appendChild(a);
-      a.click();
-      a.remove();
-      URL.revokeObjectURL(url);
-    });
-
-    copyBtn.addEventListener("click", async () => {
-      try {
-        await navigator.clipboard.writeText(output.value || "");
-        statusEl.textContent = "レポートをコピーしました。";
-        statusEl.classList.remove("error");
-      } catch(e) {
-        statusEl.textContent = "レポートのコピーに失敗しました。";
-        statusEl.classList.add("error");
-      }
-    });
-
-    updateCharCount();
-  </script>
-</body>
-</html>
-"""
+# 起動時に一度だけエンコード・圧縮しておく（GET / のたびに再計算しない）
+_HTML_BYTES = HTML_PAGE_BYTES
+_HTML_GZ = gzip.compress(_HTML_BYTES, 6)
+_HTML_BR = brotli.compress(_HTML_BYTES) if brotli is not None else None
+_HTML_ETAG = '"' + hashlib.blake2b(_HTML_BYTES, digest_size=8).hexdigest() + '"'
 
 
 # ======================
 # CSV 読み込みユーティリティ
 # ======================
 
-def guess_column(headers, kind: str):
+# 桁区切りカンマと空白をまとめて落とす変換表（replace+stripより1回の C 呼び出しで済む）
+_STRIP_COMMAS = str.maketrans("", "", ", ")
+
+# 1行=dict（約232B）ではなく軽量なタプルで持つ。数万行CSVでメモリも属性アクセスも軽くなる
+Page = namedtuple("Page", "url traffic top_keyword")
+
+
+# 列名の候補表は呼び出しごとに作り直さず、モジュール定数として1回だけ構築する
+_COLUMN_SPEC = {
+    "url": (
+        ("url", "page url", "link url", "ページurl", "リンクurl"),
+        ("url", "ページ", "リンク"),
+    ),
+    "traffic": (
+        ("traffic", "organic traffic", "search traffic", "トラフィック"),
+        ("traffic", "トラフィック"),
+    ),
+    "keyword": (
+        ("top keyword", "top keywords", "keyword", "keywords", "キーワード"),
+        ("keyword", "キーワード"),
+    ),
+}
+
+
+@lru_cache(maxsize=256)
+def _resolve_columns(headers: tuple) -> Dict[str, Optional[str]]:
+    # 小文字化は1回だけ。同じヘッダー構成のCSV（Ahrefsの通常ケース）はまるごとキャッシュが効く
     lowers = {h.lower(): h for h in headers}
 
-    if kind == "url":
-        candidates = ["url", "page url", "link url", "ページurl", "リンクurl"]
-        contains = ["url", "ページ", "リンク"]
-    elif kind == "traffic":
-        candidates = ["traffic", "organic traffic", "search traffic", "トラフィック"]
-        contains = ["traffic", "トラフィック"]
-    elif kind == "keyword":
-        candidates = ["top keyword", "top keywords", "keyword", "keywords", "キーワード"]
-        contains = ["keyword", "キーワード"]
-    else:
-        return None
+    resolved: Dict[str, Optional[str]] = {}
+    for kind, (candidates, contains) in _COLUMN_SPEC.items():
+        col = None
+        for cand in candidates:
+            if cand in lowers:
+                col = lowers[cand]
+                break
+        if col is None:
+            for h in headers:
+                hl = h.lower()
+                if any(s in hl for s in contains):
+                    col = h
+                    break
+        resolved[kind] = col
+    return resolved
 
-    for cand in candidates:
-        if cand in lowers:
-            return lowers[cand]
 
-    for h in headers:
-        hl = h.lower()
-        if any(s in hl for s in contains):
-            return h
-    return None
+def guess_column(headers, kind: str):
+    if kind not in ("url", "traffic", "keyword"):
+        return None
+    return _resolve_columns(tuple(headers))[kind]
+
+
+def detect_encoding(file_bytes: bytes) -> str:
+    # BOM付きならO(1)で確定。判定器にもかけない
+    if file_bytes.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if file_bytes.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"  # utf-16 codec がBOMを処理する
+
+    # 先頭64KBだけ見れば十分。全文を何度もデコードし直さない
+    if cn_from_bytes is not None:
+        best = cn_from_bytes(file_bytes[:65536]).best()
+        if best is not None and best.encoding:
+            enc = best.encoding
+            # BOM付きUTF-8はBOMを落とすためにutf-8-sigで読む
+            if enc == "utf_8" or enc == "utf-8":
+                return "utf-8-sig"
+            return enc
+
+    # フォールバック：先頭64KBに対して候補を順に試す
+    head = file_bytes[:65536]
+    for enc in ["utf-8-sig", "cp932", "utf-16", "utf-16-le", "utf-16-be"]:
+        try:
+            head.decode(enc)
+            return enc
+        except UnicodeDecodeError as e:
+            # 64KB境界でマルチバイト文字が切れただけなら、その文字コードで確定とみなす
+            if e.start >= len(head) - 4:
+                return enc
+            continue
+    raise HTTPException(
+        status_code=400,
+        detail="CSVの文字コードが不明です（UTF-8 / Shift-JIS / UTF-16 で保存してください）",
+    )
 
 
-def load_csv_pages_from_bytes(
-    file_bytes: bytes,
+def load_csv_pages_from_file(
+    fileobj,
     url_col_opt: Optional[str] = None,
     traffic_col_opt: Optional[str] = None,
     keyword_col_opt: Optional[str] = None,
 ):
-    for enc in ["utf-8-sig", "cp932", "utf-16", "utf-16-le", "utf-16-be"]:
-        try:
-            text = file_bytes.decode(enc)
-            break
-        except UnicodeDecodeError:
-            continue
-    else:
-        raise HTTPException(
-            status_code=400,
-            detail="CSVの文字コードが不明です（UTF-8 / Shift-JIS / UTF-16 で保存してください）",
-        )
+    # UploadFile.file（SpooledTemporaryFile）をそのまま受け取り、全量のbytesコピーを作らない
+    fileobj.seek(0)
+    head = fileobj.read(65536)
+    enc = detect_encoding(head)
 
-    f = io.StringIO(text)
-    reader = csv.DictReader(f)
-    headers = reader.fieldnames or []
+    # ヘッダー行だけ先にデコードして列を解決する（先頭4KBで十分。64KB全部はデコードしない）
+    header_line = head[:4096].decode(enc, errors="replace").split("\n", 1)[0].rstrip("\r")
+    headers = next(csv.reader(io.StringIO(header_line)), [])
 
-    url_col = url_col_opt or guess_column(headers, "url")
-    traffic_col = traffic_col_opt or guess_column(headers, "traffic")
-    keyword_col = keyword_col_opt or guess_column(headers, "keyword")
+    cols = _resolve_columns(tuple(headers))
+    url_col = url_col_opt or cols["url"]
+    traffic_col = traffic_col_opt or cols["traffic"]
+    keyword_col = keyword_col_opt or cols["keyword"]
 
     missing = []
     if not url_col:
@@ -695,26 +212,83 @@ def load_csv_pages_from_bytes(
             detail=f"CSVヘッダーから必要な列が見つかりませんでした: {', '.join(missing)} / ヘッダー: {headers}",
         )
 
-    pages = []
-    for row in reader:
-        url = row.get(url_col)
-        traffic_raw = row.get(traffic_col)
-        if not url or traffic_raw is None:
-            continue
-
-        traffic_raw = str(traffic_raw).replace(",", "").strip()
-        if traffic_raw == "":
-            continue
+    # pandas があれば列単位（C実装）でパース・変換する
+    if pd is not None:
+        fileobj.seek(0)
+        df = pd.read_csv(
+            fileobj,
+            encoding=enc,
+            usecols=[url_col, traffic_col, keyword_col],
+            dtype={url_col: str, keyword_col: str},
+            # 桁区切りカンマはCパーサー側で処理させ、トラフィック列を直接数値で受け取る
+            thousands=",",
+        )
+        df = df.rename(
+            columns={url_col: "url", traffic_col: "traffic", keyword_col: "top_keyword"}
+        )
+        if pd.api.types.is_numeric_dtype(df["traffic"]):
+            df["traffic"] = df["traffic"].astype("float64")
+        else:
+            # 「-」等の非数値が混ざると列が文字列のまま返る（pandas 3系は str dtype）。
+            # カンマを落としてから一括変換し、変換できない行は NaN → dropna で落とす
+            df["traffic"] = pd.to_numeric(
+                df["traffic"].astype(str).str.replace(",", "", regex=False).str.strip(),
+                errors="coerce",
+            )
+        df = df.dropna(subset=["url", "traffic"])
+        df["top_keyword"] = df["top_keyword"].where(df["top_keyword"].notna(), None)
+        # 行タプルに展開せず列のまま返す（merge_months がそのまま結合に使う）
+        return df[["url", "traffic", "top_keyword"]]
+
+    # 全文を一括デコードした str コピーを作らず、読み出しながら逐次デコードする
+    fileobj.seek(0)
+    f = io.TextIOWrapper(fileobj, encoding=enc, errors="replace", newline="")
+    try:
+        reader = csv.reader(f)
+        next(reader, None)  # ヘッダー行を飛ばす
+
+        # DictReader の行ごとの dict 生成＋キー参照をやめ、列番号で直接引く
+        url_idx = headers.index(url_col)
+        traffic_idx = headers.index(traffic_col)
+        keyword_idx = headers.index(keyword_col)
+        n_cols = max(url_idx, traffic_idx, keyword_idx) + 1
+
+        pages = []
+        append = pages.append
+        to_float = float
+        intern = sys.intern
+        for row in reader:
+            if len(row) < n_cols:
+                continue
+            url = row[url_idx]
+            traffic_raw = row[traffic_idx].translate(_STRIP_COMMAS)
+            if not url or traffic_raw == "":
+                continue
+
+            try:
+                traffic = to_float(traffic_raw)
+            except ValueError:
+                continue
+
+            # 同じURLは先月・今月CSVで重複する。intern しておくと merge_months の
+            # 辞書キー照合がポインタ比較で先に当たり、文字列も1実体に共有される
+            append(Page(intern(url), traffic, row[keyword_idx]))
+    finally:
+        # UploadFile 側のファイルを巻き添えでクローズしない
+        f.detach()
 
-        try:
-            traffic = float(traffic_raw)
-        except ValueError:
-            continue
+    return pages
 
-        keyword = row.get(keyword_col)
-        pages.append({"url": url, "traffic": traffic, "top_keyword": keyword})
 
-    return pages
+def load_csv_pages_from_bytes(
+    file_bytes: bytes,
+    url_col_opt: Optional[str] = None,
+    traffic_col_opt: Optional[str] = None,
+    keyword_col_opt: Optional[str] = None,
+):
+    return load_csv_pages_from_file(
+        io.BytesIO(file_bytes), url_col_opt, traffic_col_opt, keyword_col_opt
+    )
 
 
 def summarize_pages(pages: List[dict]):
@@ -726,8 +300,11 @@ def summarize_pages(pages: List[dict]):
             "total_diff_ratio": None,
             "page_count": 0,
         }
-    total_prev = sum(p["prev_traffic"] for p in pages)
-    total_current = sum(p["current_traffic"] for p in pages)
+    # 2本の生成器で2周せず、1周で両方を積む
+    total_prev = total_current = 0.0
+    for p in pages:
+        total_prev += p["prev_traffic"]
+        total_current += p["current_traffic"]
     diff = total_current - total_prev
     diff_ratio = (diff / total_prev * 100.0) if total_prev > 0 else None
     return {
@@ -739,33 +316,181 @@ def summarize_pages(pages: List[dict]):
     }
 
 
+def summarize_df(df) -> Dict[str, Any]:
+    # 生成器によるPythonループ合計ではなく、連続バッファに対するCレベルの一括集計で出す
+    if len(df) == 0:
+        return {
+            "total_traffic_prev": 0,
+            "total_traffic_current": 0,
+            "total_diff": 0,
+            "total_diff_ratio": None,
+            "page_count": 0,
+        }
+    total_prev = float(df["prev_traffic"].to_numpy().sum())
+    total_current = float(df["current_traffic"].to_numpy().sum())
+    diff = total_current - total_prev
+    diff_ratio = (diff / total_prev * 100.0) if total_prev > 0 else None
+    return {
+        "total_traffic_prev": total_prev,
+        "total_traffic_current": total_current,
+        "total_diff": diff,
+        "total_diff_ratio": diff_ratio,
+        "page_count": len(df),
+    }
+
+
+def _merge_months_df(prev_pages, curr_pages, blog_paths):
+    # URLをキーに外部結合し、差分・変化率・ブログ判定を列単位で一括計算する
+    if not isinstance(prev_pages, pd.DataFrame):
+        prev_pages = pd.DataFrame(prev_pages, columns=["url", "traffic", "top_keyword"])
+    if not isinstance(curr_pages, pd.DataFrame):
+        curr_pages = pd.DataFrame(curr_pages, columns=["url", "traffic", "top_keyword"])
+    prev_df = prev_pages.rename(
+        columns={"traffic": "prev_traffic", "top_keyword": "top_keyword_prev"}
+    )
+    curr_df = curr_pages.rename(
+        columns={"traffic": "current_traffic", "top_keyword": "top_keyword_current"}
+    )
+
+    df = prev_df.merge(curr_df, on="url", how="outer")
+    # トラフィック列はローダー側で float64 確定なので、欠損埋めだけ1回で済ませる
+    df = df.fillna({"prev_traffic": 0.0, "current_traffic": 0.0})
+    df["diff"] = df["current_traffic"] - df["prev_traffic"]
+    df["diff_ratio"] = (df["diff"] / df["prev_traffic"] * 100.0).where(
+        df["prev_traffic"] > 0, None
+    )
+
+    blog_re = _compile_blog_re(tuple(blog_paths))
+    if blog_re is not None:
+        df["is_blog"] = df["url"].str.contains(blog_re, regex=True, na=False)
+    else:
+        df["is_blog"] = False
+
+    df["top_keyword_prev"] = df["top_keyword_prev"].where(df["top_keyword_prev"].notna(), None)
+    df["top_keyword_current"] = df["top_keyword_current"].where(
+        df["top_keyword_current"].notna(), None
+    )
+
+    blog_mask = df["is_blog"].to_numpy()
+    summary = {
+        "all": summarize_df(df),
+        "blog_only": summarize_df(df[blog_mask]),
+    }
+    # 行dict（1行あたり数百バイトのオーバーヘッド）には展開せず、列指向のまま返す。
+    # dict化は select_top_movers で抜粋された数十行に対してだけ行う
+    return {"pages": df, "summary": summary}
+
+
+@lru_cache(maxsize=32)
+def _compile_blog_re(blog_paths: tuple):
+    # ブログ判定パスはリクエスト間でほぼ固定なので、コンパイル結果を使い回す
+    if not blog_paths:
+        return None
+    return re.compile("|".join(re.escape(p) for p in blog_paths))
+
+
+def _is_sorted_by_url(pages) -> bool:
+    return all(a.url <= b.url for a, b in zip(pages, pages[1:]))
+
+
+def _build_page(url, prev_tr, curr_tr, kw_prev, kw_curr, blog_re):
+    diff = curr_tr - prev_tr
+    return {
+        "url": url,
+        "prev_traffic": prev_tr,
+        "current_traffic": curr_tr,
+        "diff": diff,
+        "diff_ratio": (diff / prev_tr * 100.0) if prev_tr > 0 else None,
+        "top_keyword_prev": kw_prev,
+        "top_keyword_current": kw_curr,
+        "is_blog": bool(blog_re.search(url)) if blog_re else False,
+    }
+
+
+def _merge_months_sorted(prev_pages, curr_pages, blog_paths):
+    # 両CSVがURL昇順（Ahrefsエクスポートの既定）なら、ハッシュ表を作らず2ポインタの線形マージで済む
+    blog_re = _compile_blog_re(tuple(blog_paths))
+
+    pages = []
+    i = j = 0
+    n, m = len(prev_pages), len(curr_pages)
+    while i < n or j < m:
+        if j >= m or (i < n and prev_pages[i].url < curr_pages[j].url):
+            p = prev_pages[i]
+            i += 1
+            pages.append(_build_page(p.url, p.traffic, 0.0, p.top_keyword, None, blog_re))
+        elif i >= n or curr_pages[j].url < prev_pages[i].url:
+            c = curr_pages[j]
+            j += 1
+            pages.append(_build_page(c.url, 0.0, c.traffic, None, c.top_keyword, blog_re))
+        else:
+            p = prev_pages[i]
+            c = curr_pages[j]
+            i += 1
+            j += 1
+            pages.append(
+                _build_page(p.url, p.traffic, c.traffic, p.top_keyword, c.top_keyword, blog_re)
+            )
+
+    summary = {
+        "all": summarize_pages(pages),
+        "blog_only": summarize_pages([p for p in pages if p["is_blog"]]),
+    }
+    return {"pages": pages, "summary": summary}
+
+
 def merge_months(prev_pages, curr_pages, blog_paths=None):
     if blog_paths is None:
         blog_paths = ["/blog", "/column"]
 
+    if pd is not None:
+        return _merge_months_df(prev_pages, curr_pages, blog_paths)
+
+    # URL昇順が保たれていれば辞書マージを飛ばす
+    if _is_sorted_by_url(prev_pages) and _is_sorted_by_url(curr_pages):
+        return _merge_months_sorted(prev_pages, curr_pages, blog_paths)
+
     merged: Dict[str, Dict[str, Any]] = {}
 
+    # setdefault＋毎回のキー参照をやめ、行dictをローカルに取って直接代入する
     for p in prev_pages:
-        url = p["url"]
-        merged.setdefault(url, {})
-        merged[url]["url"] = url
-        merged[url]["prev_traffic"] = p["traffic"]
-        merged[url]["top_keyword_prev"] = p.get("top_keyword")
+        url = p.url
+        d = merged.get(url)
+        if d is None:
+            d = merged[url] = {
+                "url": url,
+                "prev_traffic": 0.0,
+                "current_traffic": 0.0,
+                "top_keyword_prev": None,
+                "top_keyword_current": None,
+            }
+        d["prev_traffic"] = p.traffic
+        d["top_keyword_prev"] = p.top_keyword
 
     for p in curr_pages:
-        url = p["url"]
-        merged.setdefault(url, {})
-        merged[url]["url"] = url
-        merged[url]["current_traffic"] = p["traffic"]
-        merged[url]["top_keyword_current"] = p.get("top_keyword")
+        url = p.url
+        d = merged.get(url)
+        if d is None:
+            d = merged[url] = {
+                "url": url,
+                "prev_traffic": 0.0,
+                "current_traffic": 0.0,
+                "top_keyword_prev": None,
+                "top_keyword_current": None,
+            }
+        d["current_traffic"] = p.traffic
+        d["top_keyword_current"] = p.top_keyword
+
+    # K本の部分一致検索をURLごとに回さず、1本の正規表現（C実装の1スキャン）にまとめる
+    blog_re = _compile_blog_re(tuple(blog_paths))
 
     pages = []
     for url, data in merged.items():
-        prev_tr = float(data.get("prev_traffic") or 0.0)
-        curr_tr = float(data.get("current_traffic") or 0.0)
+        prev_tr = data["prev_traffic"]
+        curr_tr = data["current_traffic"]
         diff = curr_tr - prev_tr
         diff_ratio = (diff / prev_tr * 100.0) if prev_tr > 0 else None
-        is_blog = any(path in url for path in blog_paths)
+        is_blog = bool(blog_re.search(url)) if blog_re else False
 
         pages.append(
             {
@@ -787,6 +512,65 @@ def merge_months(prev_pages, curr_pages, blog_paths=None):
     return {"pages": pages, "summary": summary}
 
 
+def _select_top_movers_df(df, limit: int) -> List[dict]:
+    # 列指向のままソート・抜粋し、最後に選ばれた数十行だけを dict に展開する
+    if len(df) <= limit * 4:
+        return df.to_dict("records")
+
+    # 全件ソート（O(n log n)）ではなく部分選択（O(n + k log k)）で上位だけ取る
+    by_traffic = df.nlargest(limit, "current_traffic")
+    by_gain = df.nlargest(limit, "diff")
+    by_drop = df.nsmallest(limit, "diff")
+    blog_df = df[df["is_blog"]]
+    by_blog = blog_df.loc[blog_df["diff"].abs().nlargest(limit).index]
+
+    selected = pd.concat([by_traffic, by_gain, by_drop, by_blog]).drop_duplicates(
+        subset="url"
+    )
+    return selected.to_dict("records")
+
+
+def select_top_movers(pages, limit: int = 30) -> List[dict]:
+    # 全URLをLLMに送るとトークン課金・レイテンシが行数に比例して膨らむ。
+    # トラフィック上位・増加上位・減少上位・ブログ変動上位の4視点で抜粋し、URLで重複排除する
+    if pd is not None and isinstance(pages, pd.DataFrame):
+        return _select_top_movers_df(pages, limit)
+
+    if len(pages) <= limit * 4:
+        return pages
+
+    by_traffic = sorted(pages, key=lambda p: p["current_traffic"], reverse=True)[:limit]
+    by_gain = sorted(pages, key=lambda p: p["diff"], reverse=True)[:limit]
+    by_drop = sorted(pages, key=lambda p: p["diff"])[:limit]
+    # ブログ分析の章が全体上位に埋もれないよう、ブログ記事の変動上位も必ず含める
+    by_blog = sorted(
+        (p for p in pages if p["is_blog"]), key=lambda p: abs(p["diff"]), reverse=True
+    )[:limit]
+
+    seen = set()
+    selected = []
+    for p in by_traffic + by_gain + by_drop + by_blog:
+        if p["url"] not in seen:
+            seen.add(p["url"])
+            selected.append(p)
+    return selected
+
+
+def pages_to_columns(pages: List[dict]) -> Dict[str, list]:
+    # 行dictの繰り返しだと "prev_traffic" 等のキー文字列が行数ぶんJSONに入る。
+    # 列ごとの並列リストにすると送信バイト数（＝入力トークン）が3〜4割減る
+    return {
+        "url": [p["url"] for p in pages],
+        "prev_traffic": [p["prev_traffic"] for p in pages],
+        "current_traffic": [p["current_traffic"] for p in pages],
+        "diff": [p["diff"] for p in pages],
+        "diff_ratio": [p["diff_ratio"] for p in pages],
+        "top_keyword_prev": [p["top_keyword_prev"] for p in pages],
+        "top_keyword_current": [p["top_keyword_current"] for p in pages],
+        "is_blog": [p["is_blog"] for p in pages],
+    }
+
+
 def ym_to_japanese(ym: str) -> str:
     try:
         y, m = ym.split("-")
@@ -800,34 +584,105 @@ def normalize_domain(domain: str) -> str:
     return parsed.netloc or domain
 
 
+# ======================
+# レポートキャッシュ
+# ======================
+
+# 同じCSV・同じ条件での再実行はLLMを呼ばずに前回の結果を返す。
+# キーはアップロード内容のダイジェスト＋フォーム条件。プロセス内LRUで十分小さい
+# 値は (失効時刻, レポート本文)。月次レポートなので1日で十分に新しい
+_REPORT_CACHE: "OrderedDict[tuple, tuple]" = OrderedDict()
+_REPORT_CACHE_MAX = 64
+_REPORT_CACHE_TTL = 86400.0
+
+
+def digest_upload(fileobj) -> str:
+    # blake2b は stdlib で最速クラス。1MBずつ読んで全量コピーを作らない
+    h = hashlib.blake2b(digest_size=16)
+    fileobj.seek(0)
+    while True:
+        chunk = fileobj.read(1024 * 1024)
+        if not chunk:
+            break
+        h.update(chunk)
+    fileobj.seek(0)
+    return h.hexdigest()
+
+
+def digest_report_input(report_input: dict) -> str:
+    # キー順を固定して正規化したJSONのダイジェスト。生CSVのバイト列が違っても
+    # （列順・BOM・再エクスポート差分など）マージ結果が同じなら同じ値になる
+    if orjson is not None:
+        payload = orjson.dumps(
+            report_input, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_SORT_KEYS
+        )
+    else:
+        payload = json.dumps(report_input, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+def report_cache_get(key: tuple) -> Optional[str]:
+    item = _REPORT_CACHE.get(key)
+    if item is None:
+        return None
+    expires_at, text = item
+    if expires_at < time.monotonic():
+        del _REPORT_CACHE[key]
+        return None
+    _REPORT_CACHE.move_to_end(key)
+    return text
+
+
+def report_cache_put(key: tuple, text: str) -> None:
+    _REPORT_CACHE[key] = (time.monotonic() + _REPORT_CACHE_TTL, text)
+    _REPORT_CACHE.move_to_end(key)
+    while len(_REPORT_CACHE) > _REPORT_CACHE_MAX:
+        _REPORT_CACHE.popitem(last=False)
+
+
 # ======================
 # OpenAI でレポート生成（安全化）
 # ======================
 
-def generate_report_with_openai(
-    report_input: dict,
-    domain: str,
-    month_prev: str,
-    month_current: str,
-    title: str,
-    openai_api_key: str,
-) -> str:
-    client = OpenAI(api_key=openai_api_key)
+# クライアントはモジュール単位で1つだけ作り、TLS/コネクションプールを使い回す
+_openai_client: Optional[AsyncOpenAI] = None
+
+# 同時に投げるLLMリクエスト数の上限。バーストでRPM/TPM制限に突っ込んで
+# リトライ待ちになるより、手前で並列度を絞ったほうが総スループットが出る
+_llm_semaphore = asyncio.Semaphore(int(os.getenv("OPENAI_MAX_CONCURRENCY", "8")))
+
+
+def get_openai_client() -> AsyncOpenAI:
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            http_client=httpx.AsyncClient(
+                # 並行リクエストを1本のコネクションに多重化する（h2が無ければHTTP/1.1に落ちる）
+                http2=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+                # レポート生成は1回で数十秒かかるので、既定より長めに取る
+                timeout=httpx.Timeout(120.0),
+            ),
+        )
+    return _openai_client
 
-    instructions = f"""
+
+# リクエストに依存しない指示はモジュール定数として固定する（後述のプロンプトキャッシュ用）
+_INSTRUCTIONS_STATIC = """\
 あなたは、日本の医療・歯科クリニック向けのWebマーケティングコンサルタントです。
 クライアントに提出する「月次SEOレポート」を日本語で作成してください。
+対象サイト・比較期間・レポートタイトルはユーザーメッセージの【今回の対象】で指定します。
 
 【前提】
-- 対象サイト: {domain}
-- 比較期間: 前月（{month_prev}） と 今月（{month_current}）
 - 入力データは URL ごとのオーガニックトラフィックとキーワードの情報です。
+- pages は全URLではなく「トラフィック上位・増加上位・減少上位」の抜粋です。合計値は必ず summary を使ってください。
+- pages は列指向です：url / prev_traffic / current_traffic / diff / diff_ratio / top_keyword_prev / top_keyword_current / is_blog の各リストの同じ位置（i番目）が1つのページを表します。
 - `is_blog` が true のページはブログ記事（/blog や /column 等）として扱ってください。
 - summary.all / summary.blog_only に「先月・今月の合計トラフィック」「差分」「変化率」が入っています。
 
 【出力フォーマット（Notionにそのまま貼る想定）】
-- レポート1行目に必ずタイトル（H1）：
-  # {title}
+- レポート1行目に必ず【今回の対象】で指定されたタイトル（H1）を置く
 - 見出しは H2（##）中心。各H2タイトルの先頭に絵文字（📊📈📝✅💡）を付ける
 - コードブロック（```）は絶対に使わない
 - 冒頭に以下を必ず入れる：
@@ -848,30 +703,93 @@ def generate_report_with_openai(
 - 4,000〜6,000文字程度
 """
 
-    resp = client.responses.create(
-        model="gpt-4.1",
-        input=[
-            {"role": "system", "content": instructions},
-            {"role": "user", "content": json.dumps(report_input, ensure_ascii=False)},
-        ],
+
+def build_openai_input(
+    report_input: dict,
+    domain: str,
+    month_prev: str,
+    month_current: str,
+    title: str,
+) -> List[Dict[str, str]]:
+    # リクエスト依存の条件はユーザーメッセージの先頭に置く。system側を全リクエストで
+    # バイト単位一致の固定文にしておくと、OpenAIのプロンプトキャッシュが毎回効く
+    dynamic = (
+        "【今回の対象】\n"
+        f"- 対象サイト: {domain}\n"
+        f"- 比較期間: 前月（{month_prev}） と 今月（{month_current}）\n"
+        f"- レポートタイトル（H1）: # {title}\n\n"
+    )
+    return [
+        {"role": "system", "content": _INSTRUCTIONS_STATIC},
+        {"role": "user", "content": dynamic + json_dumps_utf8(report_input)},
+    ]
+
+
+def _summary_table(s: Dict[str, Any]) -> str:
+    ratio = s["total_diff_ratio"]
+    ratio_str = f"{ratio:+.1f}%" if ratio is not None else "—"
+    return (
+        "| 指標 | 前月 | 今月 | 差分 | 変化率 |\n"
+        "| --- | --- | --- | --- | --- |\n"
+        f"| 合計トラフィック | {s['total_traffic_prev']:.0f} | {s['total_traffic_current']:.0f} "
+        f"| {s['total_diff']:+.0f} | {ratio_str} |"
     )
 
-    # 安全にテキスト抽出（output構造が変わっても落ちにくい）
-    text = getattr(resp, "output_text", None)
-    if text:
-        return text
 
-    try:
-        return resp.output[0].content[0].text
-    except Exception:
-        raise RuntimeError("OpenAIの応答からテキストを取り出せませんでした")
+def build_trivial_report(summary: Dict[str, Any], title: str) -> Optional[str]:
+    # データが空・ほぼ無変動の退化ケースは、LLMに数十秒払って「変化なし」と
+    # 言わせる価値がないので、決め打ちのテンプレートで即返す
+    s_all = summary["all"]
+    degenerate = s_all["page_count"] == 0 or (
+        abs(s_all["total_diff"]) < 1 and s_all["page_count"] < 5
+    )
+    if not degenerate:
+        return None
+
+    if s_all["page_count"] == 0:
+        note = "アップロードされたCSVから分析対象のページが見つかりませんでした。CSVの内容をご確認ください。"
+    else:
+        note = "前月と今月でトラフィックにほぼ変化がありませんでした。対象ページ数も少ないため、詳細な分析は省略します。"
+
+    return (
+        f"# {title}\n\n"
+        "## 📊 全体サマリー\n\n"
+        f"{_summary_table(s_all)}\n\n"
+        "## 📝 ブログサマリー\n\n"
+        f"{_summary_table(summary['blog_only'])}\n\n"
+        "## 📌 所見\n\n"
+        f"{note}\n"
+    )
+
+
+async def generate_report_with_openai(
+    report_input: dict,
+    domain: str,
+    month_prev: str,
+    month_current: str,
+    title: str,
+) -> str:
+    client = get_openai_client()
+
+    async with _llm_semaphore:
+        resp = await client.responses.create(
+            model="gpt-4.1",
+            input=build_openai_input(report_input, domain, month_prev, month_current, title),
+        )
+
+    # SDK公式の output_text で取り出す。空ならフォールバックせず明示的にエラーにする
+    text = resp.output_text or ""
+    if not text:
+        raise HTTPException(status_code=500, detail="OpenAIの応答が空でした")
+    return text
 
 
 # ======================
 # FastAPI アプリ本体
 # ======================
 
-app = FastAPI()
+# レスポンスJSONのエンコードも orjson（C+SIMD）に寄せる。未導入環境では標準のまま
+app = FastAPI(default_response_class=ORJSONResponse if orjson is not None else JSONResponse)
 
 # ★ 500の原因をブラウザへ返す（デバッグ用）
 @app.exception_handler(Exception)
@@ -890,6 +808,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 長文の日本語レポートJSONは gzip で約1/4になる。/ は事前圧縮済みなので二重圧縮されない
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+
+@app.on_event("startup")
+async def validate_environment():
+    # 設定漏れはリクエスト時ではなく起動直後に気付けるようにする
+    if not os.getenv("OPENAI_API_KEY"):
+        print("WARNING: OPENAI_API_KEY が未設定です。レポート生成は500になります")
+    if not os.getenv("ACCESS_TOKEN"):
+        print("WARNING: ACCESS_TOKEN が未設定です。全リクエストが500になります")
+
 
 class ReportResponse(BaseModel):
     report: str
@@ -898,40 +828,64 @@ class ReportResponse(BaseModel):
     summary: Dict[str, Any]
 
 
-@app.get("/", response_class=HTMLResponse)
-async def root():
-    return HTMLResponse(HTML_PAGE)
-
-
-@app.post("/generate-report", response_model=ReportResponse)
-async def generate_report(
-    x_access_token: Optional[str] = Header(default=None, alias="X-Access-Token"),
-
-    clinic_name: str = Form(""),
-    domain: str = Form(...),
-    month_prev: str = Form(...),
-    month_current: str = Form(...),
-    blog_paths: str = Form("/blog,/column"),
-    prev_csv: UploadFile = File(...),
-    curr_csv: UploadFile = File(...),
-):
-    require_access_token(x_access_token)
+@app.get("/")
+async def root(request: Request):
+    # 事前計算済みのバイト列をそのまま返す。ETag一致ならボディごと省略
+    if request.headers.get("if-none-match") == _HTML_ETAG:
+        return Response(status_code=304, headers={"ETag": _HTML_ETAG})
 
+    headers = {
+        "ETag": _HTML_ETAG,
+        "Vary": "Accept-Encoding",
+        "Cache-Control": "public, max-age=3600",
+    }
+    accept_encoding = request.headers.get("accept-encoding", "")
+    if _HTML_BR is not None and "br" in accept_encoding:
+        headers["Content-Encoding"] = "br"
+        return Response(content=_HTML_BR, media_type="text/html; charset=utf-8", headers=headers)
+    if "gzip" in accept_encoding:
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=_HTML_GZ, media_type="text/html; charset=utf-8", headers=headers)
+    return Response(content=_HTML_BYTES, media_type="text/html; charset=utf-8", headers=headers)
+
+
+async def prepare_report_request(
+    clinic_name: str,
+    domain: str,
+    month_prev: str,
+    month_current: str,
+    blog_paths: str,
+    prev_csv: UploadFile,
+    curr_csv: UploadFile,
+) -> Dict[str, Any]:
+    # CSVパース〜マージ〜プロンプト入力作成までの共通前処理（認証は Depends(_auth) 済み）
     openai_api_key = os.getenv("OPENAI_API_KEY")
     if not openai_api_key:
         raise HTTPException(status_code=500, detail="OPENAI_API_KEY がサーバー側で設定されていません")
 
-    prev_bytes = await prev_csv.read()
-    curr_bytes = await curr_csv.read()
+    # キャッシュキー用にアップロード内容のダイジェストを先に取っておく
+    prev_digest, curr_digest = await asyncio.gather(
+        asyncio.to_thread(digest_upload, prev_csv.file),
+        asyncio.to_thread(digest_upload, curr_csv.file),
+    )
+    cache_key = (prev_digest, curr_digest, clinic_name, domain, month_prev, month_current, blog_paths)
 
-    prev_pages = load_csv_pages_from_bytes(prev_bytes)
-    curr_pages = load_csv_pages_from_bytes(curr_bytes)
+    # UploadFile の実体（SpooledTemporaryFile）を直接パーサへ渡し、bytesの全量コピーを作らない
+    # 2ファイルは独立なのでワーカースレッドで並列にパースし、イベントループも塞がない
+    prev_pages, curr_pages = await asyncio.gather(
+        asyncio.to_thread(load_csv_pages_from_file, prev_csv.file),
+        asyncio.to_thread(load_csv_pages_from_file, curr_csv.file),
+    )
 
-    if not prev_pages and not curr_pages:
+    # pandas パスでは DataFrame が返るので真偽値ではなく件数で見る
+    if len(prev_pages) == 0 and len(curr_pages) == 0:
         raise HTTPException(status_code=400, detail="CSVからデータを読み取れませんでした")
 
     blog_path_list = [p.strip() for p in blog_paths.split(",") if p.strip()]
-    merged = merge_months(prev_pages, curr_pages, blog_paths=blog_path_list)
+    # 大きな結合もイベントループを塞がないようワーカースレッドで実行する
+    merged = await asyncio.to_thread(
+        merge_months, prev_pages, curr_pages, blog_paths=blog_path_list
+    )
 
     dom = normalize_domain(domain)
     jp_prev = ym_to_japanese(month_prev)
@@ -944,20 +898,210 @@ async def generate_report(
         "clinic_name": clinic_name,
         "month_prev": month_prev,
         "month_current": month_current,
-        "pages": merged["pages"],
+        "pages": pages_to_columns(select_top_movers(merged["pages"])),
         "summary": merged["summary"],
     }
 
-    report_text = generate_report_with_openai(
-        report_input, dom, month_prev, month_current, title, openai_api_key
-    )
-
     safe_dom = dom.replace(":", "_").replace("/", "_")
     filename = f"report_{safe_dom}_{month_current}.md"
 
+    return {
+        "report_input": report_input,
+        "domain": dom,
+        "month_prev": month_prev,
+        "month_current": month_current,
+        "title": title,
+        "filename": filename,
+        "summary": merged["summary"],
+        "cache_key": cache_key,
+        # 第2層キー：正規化したLLM入力のダイジェスト。ファイルは違うが中身が同じ再実行を拾う
+        "input_cache_key": ("input", digest_report_input(report_input)),
+    }
+
+
+@app.post("/generate-report", response_model=ReportResponse, dependencies=[Depends(_auth)])
+async def generate_report(
+    clinic_name: str = Form(""),
+    domain: str = Form(...),
+    month_prev: str = Form(...),
+    month_current: str = Form(...),
+    blog_paths: str = Form("/blog,/column"),
+    prev_csv: UploadFile = File(...),
+    curr_csv: UploadFile = File(...),
+):
+    ctx = await prepare_report_request(
+        clinic_name, domain, month_prev, month_current,
+        blog_paths, prev_csv, curr_csv,
+    )
+
+    # 生ファイルのダイジェスト→正規化済みLLM入力のダイジェストの2段で引く
+    report_text = report_cache_get(ctx["cache_key"])
+    if report_text is None:
+        report_text = report_cache_get(ctx["input_cache_key"])
+    if report_text is None:
+        # 空CSV・無変動などの退化ケースはLLMを呼ばずテンプレートで返す
+        report_text = build_trivial_report(ctx["summary"], ctx["title"])
+    if report_text is None:
+        report_text = await generate_report_with_openai(
+            ctx["report_input"], ctx["domain"], month_prev, month_current, ctx["title"]
+        )
+        report_cache_put(ctx["cache_key"], report_text)
+        report_cache_put(ctx["input_cache_key"], report_text)
+
     return ReportResponse(
         report=report_text,
-        filename=filename,
-        title=title,
-        summary=merged["summary"],
+        filename=ctx["filename"],
+        title=ctx["title"],
+        summary=ctx["summary"],
+    )
+
+
+@app.post("/generate-report-stream", dependencies=[Depends(_auth)])
+async def generate_report_stream(
+    clinic_name: str = Form(""),
+    domain: str = Form(...),
+    month_prev: str = Form(...),
+    month_current: str = Form(...),
+    blog_paths: str = Form("/blog,/column"),
+    prev_csv: UploadFile = File(...),
+    curr_csv: UploadFile = File(...),
+):
+    # 生成完了まで無応答にせず、トークンを逐次SSEで流す（体感は最初のトークンまでの時間になる）
+    ctx = await prepare_report_request(
+        clinic_name, domain, month_prev, month_current,
+        blog_paths, prev_csv, curr_csv,
+    )
+
+    llm_input = build_openai_input(
+        ctx["report_input"], ctx["domain"], month_prev, month_current, ctx["title"]
+    )
+
+    async def event_generator():
+        client = get_openai_client()
+        try:
+            cached = report_cache_get(ctx["cache_key"])
+            if cached is None:
+                cached = report_cache_get(ctx["input_cache_key"])
+            if cached is None:
+                # 空CSV・無変動などの退化ケースもLLMを呼ばずテンプレートで返す
+                cached = build_trivial_report(ctx["summary"], ctx["title"])
+            if cached is not None:
+                # キャッシュヒット時はLLMを呼ばず全文を1イベントで返す
+                yield "data: " + json_dumps_utf8({"delta": cached}) + "\n\n"
+            else:
+                chunks = []
+                async with _llm_semaphore:
+                    async with client.responses.stream(model="gpt-4.1", input=llm_input) as stream:
+                        async for event in stream:
+                            if event.type == "response.output_text.delta":
+                                chunks.append(event.delta)
+                                yield "data: " + json_dumps_utf8({"delta": event.delta}) + "\n\n"
+                report_text = "".join(chunks)
+                report_cache_put(ctx["cache_key"], report_text)
+                report_cache_put(ctx["input_cache_key"], report_text)
+            yield "data: " + json_dumps_utf8(
+                {
+                    "done": True,
+                    "filename": ctx["filename"],
+                    "title": ctx["title"],
+                    "summary": ctx["summary"],
+                }
+            ) + "\n\n"
+        except Exception as exc:
+            print("STREAM ERROR:", type(exc).__name__, str(exc))
+            yield "data: " + json_dumps_utf8(
+                {"error": f"{type(exc).__name__}: {str(exc)[:300]}"}
+            ) + "\n\n"
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream")
+
+
+@app.post("/generate-report-batch", status_code=202, dependencies=[Depends(_auth)])
+async def generate_report_batch(
+    clinic_name: str = Form(""),
+    domain: str = Form(...),
+    month_prev: str = Form(...),
+    month_current: str = Form(...),
+    blog_paths: str = Form("/blog,/column"),
+    prev_csv: UploadFile = File(...),
+    curr_csv: UploadFile = File(...),
+):
+    # 急がないレポートは Batch API に回す（トークン単価が50%になる）。
+    # 202 で batch_id を返し、結果は /batch-result/{batch_id} で取る
+    ctx = await prepare_report_request(
+        clinic_name, domain, month_prev, month_current,
+        blog_paths, prev_csv, curr_csv,
+    )
+
+    llm_input = build_openai_input(
+        ctx["report_input"], ctx["domain"], month_prev, month_current, ctx["title"]
+    )
+    line = {
+        "custom_id": "report-1",
+        "method": "POST",
+        "url": "/v1/responses",
+        "body": {"model": "gpt-4.1", "input": llm_input},
+    }
+
+    client = get_openai_client()
+    uploaded = await client.files.create(
+        file=("report_batch.jsonl", json_dumps_utf8(line).encode("utf-8")),
+        purpose="batch",
+    )
+    batch = await client.batches.create(
+        input_file_id=uploaded.id,
+        endpoint="/v1/responses",
+        completion_window="24h",
+    )
+
+    return {
+        "batch_id": batch.id,
+        "status": batch.status,
+        "filename": ctx["filename"],
+        "title": ctx["title"],
+        "summary": ctx["summary"],
+    }
+
+
+@app.get("/batch-result/{batch_id}", dependencies=[Depends(_auth)])
+async def batch_result(batch_id: str):
+    client = get_openai_client()
+    batch = await client.batches.retrieve(batch_id)
+    if batch.status != "completed":
+        return {"batch_id": batch_id, "status": batch.status}
+
+    content = await client.files.content(batch.output_file_id)
+    line = json.loads(content.text.splitlines()[0])
+
+    # Batch の出力は Responses API のボディがそのまま入っている
+    text = ""
+    for item in line["response"]["body"].get("output", []):
+        for part in item.get("content", []):
+            if part.get("type") == "output_text":
+                text += part.get("text", "")
+
+    if not text:
+        raise HTTPException(status_code=500, detail="Batchの応答からテキストを取り出せませんでした")
+
+    return {"batch_id": batch_id, "status": "completed", "report": text}
+
+
+# ======================
+# ローカル起動用
+# ======================
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvicorn[standard] に同梱の uvloop / httptools を明示指定し、
+    # イベントループとHTTPパースをC実装で回す（本番のCMDも同じ指定にすること）
+    # ワーカー数は WEB_CONCURRENCY で指定（目安: CPUコア数）。プロセスごとに
+    # イベントループが立つので、CSVパースなどCPU仕事もコア数ぶんスケールする
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        loop="uvloop",
+        http="httptools",
     )